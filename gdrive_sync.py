@@ -1,23 +1,61 @@
 # gdrive_sync.py
-import os, json, io, re
+import os, json, re, threading, functools, uuid
 from pathlib import Path
 from typing import List, Dict
+import aiofiles
+import httpx
+import httplib2
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+METADATA_FIELDS = "id,name,modifiedTime,md5Checksum,size"
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media"
+MEDIA_STREAM_CHUNK = 1 << 20  # async downloads are written to disk 1 MB at a time
+# httplib2 on-disk cache: unchanged metadata/list responses revalidate via ETag (304, no body)
+HTTP_CACHE_DIR = os.environ.get("DRIVE_HTTP_CACHE_DIR", ".http_cache")
 
-def get_drive_service():
-    raw = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
-    if not raw:
-        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not set")
+_SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+_local = threading.local()
+_token_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _credentials(raw: str):
+    """Parsed service-account credentials, cached per env value so a rotated key is picked up."""
     info = json.loads(raw)
     # Important: fix escaped newlines in the private key
     if "private_key" in info:
         info["private_key"] = info["private_key"].replace("\\n", "\n")
-    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-    return build("drive", "v3", credentials=creds, cache_discovery=False)
+    return service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+
+def get_drive_service():
+    raw = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if not raw:
+        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not set")
+    http = google_auth_httplib2.AuthorizedHttp(_credentials(raw), http=httplib2.Http(cache=HTTP_CACHE_DIR))
+    return build("drive", "v3", http=http, cache_discovery=False)
+
+def get_thread_drive_service():
+    """One service per thread: the httplib2 transport behind googleapiclient is not thread-safe."""
+    raw = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
+    svc = getattr(_local, "svc", None)
+    if svc is None or getattr(_local, "raw", None) != raw:
+        svc = _local.svc = get_drive_service()
+        _local.raw = raw
+    return svc
+
+def get_access_token() -> str:
+    """Bearer token from the cached credentials, refreshed when expired (blocking)."""
+    raw = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if not raw:
+        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not set")
+    creds = _credentials(raw)
+    with _token_lock:
+        if not creds.valid:
+            creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+        return creds.token
 
 def list_pdfs_in_folder(svc, folder_id: str) -> List[Dict]:
     q = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
@@ -25,7 +63,7 @@ def list_pdfs_in_folder(svc, folder_id: str) -> List[Dict]:
     while True:
         resp = svc.files().list(
             q=q, pageSize=1000, pageToken=token,
-            fields="nextPageToken, files(id,name)"
+            fields=f"nextPageToken, files({METADATA_FIELDS})"
         ).execute()
         files.extend(resp.get("files", []))
         token = resp.get("nextPageToken")
@@ -33,15 +71,22 @@ def list_pdfs_in_folder(svc, folder_id: str) -> List[Dict]:
             break
     return files
 
-def download_pdf(svc, file_id: str, dest: Path):
+async def download_pdf_async(client: httpx.AsyncClient, token: str, file_id: str, dest: Path):
+    """Stream a Drive file to dest over a shared async client (many can run concurrently)."""
     dest.parent.mkdir(parents=True, exist_ok=True)
-    req = svc.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, req)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
-    dest.write_bytes(fh.getvalue())
+    # Unique per download: overlapping syncs of the same file must not share (and steal) a temp file
+    tmp = dest.with_name(f"{dest.name}.{uuid.uuid4().hex}.part")
+    headers = {"Authorization": f"Bearer {token}"}
+    try:
+        async with client.stream("GET", DRIVE_MEDIA_URL.format(file_id), headers=headers) as r:
+            r.raise_for_status()
+            async with aiofiles.open(tmp, "wb") as fh:
+                async for chunk in r.aiter_bytes(MEDIA_STREAM_CHUNK):
+                    await fh.write(chunk)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
 def safe_name(name: str) -> str:
-    return re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+    return _SAFE_NAME_RE.sub("_", name)
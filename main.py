@@ -1,96 +1,394 @@
 # main.py
 import os
-import json
+import asyncio
+import functools
+import multiprocessing
 import uuid
 import re
+import threading
+import traceback
 import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
 from typing import Optional, Literal
 
+import aiofiles
 import httpx
+import orjson
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from rapidfuzz import fuzz, process
 
 from pds_extractor import extract_pds
-from gdrive_sync import get_drive_service, list_pdfs_in_folder, download_pdf, safe_name
+from gdrive_sync import (
+    get_thread_drive_service, get_access_token, list_pdfs_in_folder, download_pdf_async, safe_name,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP/2 client for the whole process: URL and Drive downloads reuse connections
+    app.state.http = httpx.AsyncClient(
+        follow_redirects=True,
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        _PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+
 
-app = FastAPI(title="Valvoline PDS MVP")
+app = FastAPI(title="Valvoline PDS MVP", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # ------------------------- FOLDERS & INDEX -------------------------
 DATA_DIR   = Path("data");   DATA_DIR.mkdir(exist_ok=True)
 PARSED_DIR = Path("parsed"); PARSED_DIR.mkdir(exist_ok=True)
 INDEX_PATH = Path("index.json")
+DRIVE_CACHE_PATH = Path("drive_cache.json")  # Drive file id -> what we last synced
+
+# Blocking Drive helpers (token refresh, listing, parsed-JSON writes) share one thread pool
+IO_WORKERS = 16
+DOWNLOAD_CONCURRENCY = 10  # simultaneous media downloads per sync (async, on app.state.http)
+STREAM_CHUNK_SIZE = 1 << 20  # uploads and URL downloads are streamed to disk 1 MB at a time
+JSON_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS  # parsed side-cars stay human-readable
+STATE_JSON_OPTS = orjson.OPT_NON_STR_KEYS  # index/drive cache are machine-only: compact
 
 
 def _load_index() -> dict:
     if INDEX_PATH.exists():
-        return json.loads(INDEX_PATH.read_text(encoding="utf-8"))
+        return orjson.loads(INDEX_PATH.read_bytes())
     return {}
 
 
+def _write_json_atomic(path: Path, obj, option: int = JSON_OPTS) -> None:
+    """Write JSON via a temp file + os.replace so readers never see a half-written file."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(orjson.dumps(obj, option=option))
+    os.replace(tmp, path)
+
+
+def _index_mtime() -> int:
+    try:
+        return INDEX_PATH.stat().st_mtime_ns
+    except OSError:
+        return 0
+
+
+# The index lives in memory; index.json is only written by _flush_index().
+# _INDEX_MTIME is the file version _INDEX reflects, so entries other worker
+# processes flushed are merged in by _refresh_index() on read and by
+# _flush_index() before writing (so a flush never drops them).
+# _PENDING holds this process's entries since its last flush; they win on merge.
+_INDEX: dict = _load_index()
+_INDEX_MTIME: int = _index_mtime()
+_PENDING: dict = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def _merge_disk_index() -> None:
+    """Fold index.json into _INDEX, keeping unflushed local entries on top. Caller holds _INDEX_LOCK."""
+    _INDEX.update(_load_index())
+    _INDEX.update(_PENDING)
+    _rebuild_lookup(_INDEX)
+
+
+def _refresh_index() -> None:
+    """Merge index.json back in if another process rewrote it since we last loaded/flushed."""
+    global _INDEX_MTIME
+    mtime = _index_mtime()
+    if mtime == _INDEX_MTIME:
+        return
+    with _INDEX_LOCK:
+        if mtime != _INDEX_MTIME:
+            _merge_disk_index()
+            _INDEX_MTIME = mtime
+
+
+def _index_snapshot() -> dict:
+    _refresh_index()
+    with _INDEX_LOCK:
+        return dict(_INDEX)
+
+
 def _save_index_entry(product_name: str, pdf_path: Path) -> None:
     """Store mapping: name/alias -> local PDF path (string). Multiple keys can point to the same PDF."""
-    if not product_name:
+    if not product_name or not product_name.strip():
         return
-    idx = _load_index()
-    idx[product_name.strip()] = str(pdf_path)
-    INDEX_PATH.write_text(json.dumps(idx, ensure_ascii=False, indent=2), encoding="utf-8")
+    with _INDEX_LOCK:
+        _INDEX[product_name.strip()] = _PENDING[product_name.strip()] = str(pdf_path)
+        _add_lookup(product_name.strip(), str(pdf_path))
+
+
+def _flush_index() -> None:
+    """Persist the in-memory index to index.json, merged with whatever other processes wrote."""
+    global _INDEX_MTIME
+    with _INDEX_LOCK:
+        if _index_mtime() != _INDEX_MTIME:
+            _merge_disk_index()
+        _write_json_atomic(INDEX_PATH, _INDEX, STATE_JSON_OPTS)
+        _PENDING.clear()
+        _INDEX_MTIME = _index_mtime()
+
+
+def _load_drive_cache() -> dict:
+    if DRIVE_CACHE_PATH.exists():
+        return orjson.loads(DRIVE_CACHE_PATH.read_bytes())
+    return {}
+
+
+def _same_content(entry: dict, f: dict) -> bool:
+    """Compare by md5Checksum when Drive reports one (a touch without edits keeps it), else by modifiedTime."""
+    if f.get("md5Checksum") and entry.get("md5Checksum"):
+        return entry["md5Checksum"] == f["md5Checksum"]
+    return bool(f.get("modifiedTime")) and entry.get("modifiedTime") == f.get("modifiedTime")
+
+
+def _is_unchanged(entry: Optional[dict], f: dict) -> bool:
+    """
+    True if the Drive file matches what we synced last time, still maps to the same local file
+    (a rename keeps the md5, but the PDF must move to its new name and be indexed under it),
+    and both local artifacts still exist.
+    """
+    return bool(
+        entry
+        and _same_content(entry, f)
+        and entry.get("local_path") == str(DATA_DIR / safe_name(f["name"]))
+        and os.path.exists(entry.get("local_path", ""))
+        and os.path.exists(entry.get("parsed_path", ""))
+    )
 
 
 # ------------------------- NAME NORMALIZATION -------------------------
+_WS_RE = re.compile(r"\s+")
+
+
+def _norm_prop(s: str) -> str:
+    """Property-name key used to line up rows of two sheets in a comparison."""
+    return _WS_RE.sub(" ", (s or "").strip()).lower()
+
+
+_ROW = "| {} | {} | {} |".format
+# extract_pds always emits these keys on every typical_properties row
+_PROP = itemgetter("property_name", "value", "test_method")
+
+
+def _cell(value: str, method: Optional[str]) -> str:
+    """Comparison cell: value plus '(test method)' when the sheet gives one."""
+    return f"{value} ({method})" if method else value
+
+
+def _compare_rows(propsA: list, cellsB: dict):
+    """Comparison table rows: each property of A against the same-named property of B (if any)."""
+    for name, value, method in map(_PROP, propsA):
+        yield _ROW(name, _cell(value, method), cellsB.get(_norm_prop(name), "—"))
+
+
+def _render_summary(A: dict, fallback_name: str) -> str:
+    """Markdown summary of one parsed sheet."""
+    approvals = A.get("approvals_and_specs", []) or []
+    approvals_md = "- " + "; ".join(approvals) if approvals else "—"
+    props_md = "\n".join(
+        f"- {name}: {value}" + (f" ({method})" if method else "")
+        for name, value, method in map(_PROP, A.get("typical_properties", []) or [])
+    )
+    return (
+        f"**Product:** {A.get('product_name_line') or fallback_name}\n\n"
+        f"**Revision:** {A.get('version') or '—'}\n\n"
+        f"**Approvals / Specifications:**\n{approvals_md}\n\n"
+        f"**Typical properties:**\n{props_md}"
+    )
+
+
+def _render_comparison(A: dict, B: dict, nameA_fallback: str, nameB_fallback: str) -> str:
+    """Markdown comparison table of A's properties against B's, followed by both approval lists."""
+    # B's cells are formatted once, keyed by normalized property name
+    cellsB = {
+        _norm_prop(name): _cell(value, method)
+        for name, value, method in map(_PROP, B.get("typical_properties", []) or [])
+    }
+
+    nameA = A.get("product_name_line") or nameA_fallback
+    nameB = B.get("product_name_line") or nameB_fallback
+    verA = A.get("version") or ""
+    verB = B.get("version") or ""
+
+    header = (
+        f"**Sammenligning:** {nameA} (Rev. {verA}) vs {nameB} (Rev. {verB})",
+        "",
+        f"| Egenskap | {nameA} | {nameB} |",
+        "|---|---|---|",
+    )
+    rows = _compare_rows(A.get("typical_properties", []) or [], cellsB)
+    footer = ["", "**Godkjenninger / spesifikasjoner:**"]
+    if A.get("approvals_and_specs"):
+        footer.append("- " + nameA + ": " + "; ".join(A["approvals_and_specs"]))
+    if B.get("approvals_and_specs"):
+        footer.append("- " + nameB + ": " + "; ".join(B["approvals_and_specs"]))
+    return "\n".join(chain(header, rows, footer))
+
+
+class _KeepAlnum(dict):
+    """
+    str.translate table: keep a-z/0-9, drop every other code point. Filled in lazily, but only
+    for Latin code points, so client-supplied names can't grow it without bound.
+    """
+    def __missing__(self, cp: int):
+        out = cp if 48 <= cp <= 57 or 97 <= cp <= 122 else None
+        if cp < 0x250:
+            self[cp] = out
+        return out
+
+
+_KEEP_ALNUM = _KeepAlnum()
+
+
 def _norm_name(s: str) -> str:
     """
     Normalize product names & filename-like tokens so
     'SynPower ENV C2 5W-30' == 'synpower env c 2 5w30' == 'EUR_Val_SynENVC2_5W30_MO_EN'
     """
     s = (s or "").lower()
-    # strip accents / symbols
-    s = ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
-    # drop non-alphanum
-    s = re.sub(r'[^a-z0-9]', '', s)
-    # unify common grade tokens
-    s = s.replace('0w40', '0w40').replace('0w30', '0w30').replace('0w20', '0w20')
-    s = s.replace('5w30', '5w30').replace('5w40', '5w40').replace('5w20', '5w20')
-    s = s.replace('10w40', '10w40').replace('10w30', '10w30').replace('10w50', '10w50')
-    # unify C-class tokens (ENV C 2 -> envc2)
-    s = s.replace('c1', 'c1').replace('c2', 'c2').replace('c3', 'c3').replace('c4', 'c4')
-    return s
+    # NFKD splits accents into combining marks, which the table drops with all other non-alphanumerics;
+    # the quick check skips the copy for names that are already normalized (plain ASCII always is)
+    if not unicodedata.is_normalized("NFKD", s):
+        s = unicodedata.normalize("NFKD", s)
+    return s.translate(_KEEP_ALNUM)
+
+
+# Index keys are normalized again on every rebuild, so memoize them; queries are client-chosen
+# strings and go through _norm_name uncached so they can't pin memory in the cache.
+_norm_key = functools.lru_cache(maxsize=8192)(_norm_name)
+
+
+FUZZY_CUTOFF = 75  # minimum rapidfuzz WRatio for a misspelled name to resolve
+
+# Lookup tables derived from _INDEX: built in full when index.json is (re)loaded,
+# then kept current entry by entry in _save_index_entry. Guarded by _INDEX_LOCK.
+_NORM_MAP: dict = {}     # normalized name or filename stem -> PDF path
+_NORM_ORDER: dict = {}   # normalized key -> insertion position (ties go to the first)
+_TRIGRAMS: dict = {}     # 3-char substring -> set of normalized keys containing it
+
+
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def _add_lookup(name: str, path: str) -> None:
+    """Register one index entry under its normalized name and filename stem."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for alias in (name, stem):
+        nk = _norm_key(alias)
+        _NORM_ORDER.setdefault(nk, len(_NORM_ORDER))
+        _NORM_MAP[nk] = path
+        for g in _trigrams(nk):
+            _TRIGRAMS.setdefault(g, set()).add(nk)
+
+
+def _rebuild_lookup(idx: dict) -> None:
+    """Build the normalized map (names + filename stems as aliases) and its trigram index from scratch."""
+    _NORM_MAP.clear()
+    _NORM_ORDER.clear()
+    _TRIGRAMS.clear()
+    for k, v in idx.items():
+        _add_lookup(k, v)
 
 
 def _resolve_by_name(name: str) -> Path:
     """
     Resolve a user-provided product name or filename to a local PDF path using:
       - exact normalized match on human name or filename stem
-      - substring fallback on normalized keys
+      - substring fallback on normalized keys (candidates from the trigram index, closest wins)
+      - fuzzy fallback (rapidfuzz WRatio >= FUZZY_CUTOFF) for typos
     Index may contain multiple keys for the same file.
     """
-    idx = _load_index()
-    if not idx:
-        raise HTTPException(404, "Index is empty; run /drive/sync first")
+    _refresh_index()
+    with _INDEX_LOCK:
+        if not _NORM_MAP:
+            raise HTTPException(404, "Index is empty; run /drive/sync first")
+        hit = _lookup(_norm_name(name))
+    if hit is None:
+        raise HTTPException(404, f"Could not find a PDF for '{name}'")
+    return Path(hit)
+
+
+def _lookup(q: str) -> Optional[str]:
+    """Path for normalized query q, or None. Caller holds _INDEX_LOCK."""
+    # exact normalized
+    if q in _NORM_MAP:
+        return _NORM_MAP[q]
 
-    # Build normalization map including filename stems as aliases
-    norm_map = {}
-    for k, v in idx.items():
-        try:
-            norm_map[_norm_name(k)] = v
-            stem = Path(v).stem
-            norm_map[_norm_name(stem)] = v
-        except Exception:
-            continue
+    # relaxed: substring; any key containing q contains all of q's trigrams
+    grams = _trigrams(q)
+    if not grams:
+        # too short to index: scan
+        return next((v for nk, v in _NORM_MAP.items() if q in nk), None)
+    postings = sorted((_TRIGRAMS.get(g, set()) for g in grams), key=len)
+    hits = [nk for nk in postings[0].intersection(*postings[1:]) if q in nk]
+    if hits:
+        best = max(hits, key=lambda nk: (fuzz.ratio(q, nk), -_NORM_ORDER[nk]))
+        return _NORM_MAP[best]
 
-    q = _norm_name(name)
+    # last resort: typo-tolerant match, scored in C by rapidfuzz
+    match = process.extractOne(q, _NORM_MAP.keys(), scorer=fuzz.WRatio, score_cutoff=FUZZY_CUTOFF)
+    return _NORM_MAP[match[0]] if match else None
 
-    # exact normalized
-    if q in norm_map:
-        return Path(norm_map[q])
 
-    # relaxed: substring
-    for nk, v in norm_map.items():
-        if q in nk:
-            return Path(v)
+_rebuild_lookup(_INDEX)
 
-    raise HTTPException(404, f"Could not find a PDF for '{name}'")
+
+# ------------------------- PARSE CACHE -------------------------
+def _parsed_path(pdf_path: Path) -> Path:
+    return PARSED_DIR / (pdf_path.stem + ".json")
+
+
+def _load_parsed(path: str, mtime_ns: int, size: int) -> dict:
+    """
+    Parsed sheet from parsed/<stem>.json when its embedded _cache_key matches
+    the PDF; otherwise run extract_pds and store the result with its key.
+    """
+    key = [path, mtime_ns, size]
+    json_path = _parsed_path(Path(path))
+    try:
+        cached = orjson.loads(json_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        cached = None
+    if isinstance(cached, dict) and cached.pop("_cache_key", None) == key:
+        return cached
+
+    parsed = extract_pds(path)
+    try:
+        _write_json_atomic(json_path, {**parsed, "_cache_key": key})
+    except OSError:
+        pass  # the cache is an optimization; never fail the request over it
+    return parsed
+
+
+@functools.lru_cache(maxsize=512)
+def _extract_cached(path: str, mtime_ns: int, size: int) -> dict:
+    """Hot sheets stay in memory, the long tail is on disk; the returned dict is shared, treat it as read-only."""
+    return _load_parsed(path, mtime_ns, size)
+
+
+def _extract(pdf_path: Path, st: Optional[os.stat_result] = None) -> dict:
+    """Parse via the cache; pass the stat_result if the caller already has one."""
+    st = st or pdf_path.stat()
+    return _extract_cached(str(pdf_path), st.st_mtime_ns, st.st_size)
+
+
+def _stat_or_400(p: Path, field: str) -> os.stat_result:
+    """Validate a client-supplied path with one stat; the result also keys the parse cache."""
+    try:
+        return p.stat()
+    except OSError:
+        raise HTTPException(400, f"{field} not found")
 
 
 # ------------------------- REQUEST MODELS -------------------------
@@ -120,20 +418,47 @@ def health():
 
 @app.post("/upload")
 async def upload_pdf(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(".pdf"):
+    # Case-fold only the extension; a missing filename is rejected like any non-PDF
+    if (file.filename or "")[-4:].lower() != ".pdf":
         raise HTTPException(400, "Please upload a PDF")
     out = DATA_DIR / f"{uuid.uuid4().hex}.pdf"
-    out.write_bytes(await file.read())
+    async with aiofiles.open(out, "wb") as fh:
+        while chunk := await file.read(STREAM_CHUNK_SIZE):
+            await fh.write(chunk)
     return {"stored_as": str(out)}
 
 
-async def _download_pdf_to_disk(url: str) -> Path:
-    async with httpx.AsyncClient(follow_redirects=True, timeout=60) as client:
-        r = await client.get(url)
-        if r.status_code != 200 or b"%PDF" not in r.content[:1024]:
+async def _download_pdf_to_disk(url: str, client: httpx.AsyncClient) -> Path:
+    async with client.stream("GET", url) as r:
+        if r.status_code != 200:
+            raise HTTPException(400, "URL did not return a valid PDF")
+        # Unchunked iteration yields data as it arrives, so only the first ~1 KB (plus at most
+        # one network read) is pulled before the magic check; writes are batched to 1 MB after
+        body = r.aiter_bytes()
+        buf = bytearray()
+        async for chunk in body:
+            buf += chunk
+            if len(buf) >= 1024:
+                break
+        # Bounded find: no slice copy, and still tolerant of bytes before the header
+        if buf.find(b"%PDF", 0, 1024) == -1:
             raise HTTPException(400, "URL did not return a valid PDF")
         out = DATA_DIR / f"{uuid.uuid4().hex}.pdf"
-        out.write_bytes(r.content)
+        # Stream into a temp file and publish only a complete download; a dropped connection
+        # must not leave a truncated PDF behind
+        tmp = out.with_name(out.name + ".part")
+        try:
+            async with aiofiles.open(tmp, "wb") as fh:
+                async for chunk in body:
+                    buf += chunk
+                    if len(buf) >= STREAM_CHUNK_SIZE:
+                        await fh.write(buf)
+                        buf.clear()
+                await fh.write(buf)
+            os.replace(tmp, out)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
         return out
 
 
@@ -141,91 +466,79 @@ async def _download_pdf_to_disk(url: str) -> Path:
 @app.post("/answer")
 async def answer(req: AnswerReq):
     # ---- Resolve A ----
+    stA = None
     if req.product_a_file:
         pA = Path(req.product_a_file)
-        if not pA.exists():
-            raise HTTPException(400, "product_a_file not found")
+        stA = _stat_or_400(pA, "product_a_file")
     elif req.product_a_url:
-        pA = await _download_pdf_to_disk(req.product_a_url)
+        pA = await _download_pdf_to_disk(req.product_a_url, app.state.http)
     else:
         raise HTTPException(400, "Provide product_a_file or product_a_url")
 
-    A = extract_pds(str(pA))
+    # PDF parsing blocks; run it off the event loop
+    A = await run_in_threadpool(_extract, pA, stA)
 
     # ---- Summary only? ----
     if req.expected_output == "summary" or not (req.product_b_file or req.product_b_url):
-        approvals = A.get("approvals_and_specs", []) or []
-        approvals_md = "- " + "; ".join(approvals) if approvals else "—"
-        props = A.get("typical_properties", []) or []
-        props_md = "\n".join(
-            f"- {p.get('property_name','')}: {p.get('value','')}"
-            + (f" ({p.get('test_method')})" if p.get("test_method") else "")
-            for p in props
-        )
-        md = (
-            f"**Product:** {A.get('product_name_line') or Path(A.get('pdf','')).name}\n\n"
-            f"**Revision:** {A.get('version') or '—'}\n\n"
-            f"**Approvals / Specifications:**\n{approvals_md}\n\n"
-            f"**Typical properties:**\n{props_md}"
-        )
-        return JSONResponse({"reply_markdown": md, "productA": A})
+        md = _render_summary(A, Path(A.get("pdf", "")).name)
+        return ORJSONResponse({"reply_markdown": md, "productA": A})
 
     # ---- Otherwise, resolve B and compare ----
+    stB = None
     if req.product_b_file:
         pB = Path(req.product_b_file)
-        if not pB.exists():
-            raise HTTPException(400, "product_b_file not found")
+        stB = _stat_or_400(pB, "product_b_file")
     elif req.product_b_url:
-        pB = await _download_pdf_to_disk(req.product_b_url)
+        pB = await _download_pdf_to_disk(req.product_b_url, app.state.http)
     else:
         raise HTTPException(400, "Provide product_b_file or product_b_url")
 
-    B = extract_pds(str(pB))
+    B = await run_in_threadpool(_extract, pB, stB)
 
-    import re as _re
-    norm = lambda s: _re.sub(r"\s+", " ", (s or "").strip()).lower()
-    mapB = {norm(p.get("property_name", "")): p for p in B.get("typical_properties", []) or []}
+    md = _render_comparison(A, B, Path(A.get("pdf", "")).name, Path(B.get("pdf", "")).name)
 
-    nameA = A.get("product_name_line") or Path(A.get("pdf", "")).name
-    nameB = B.get("product_name_line") or Path(B.get("pdf", "")).name
-    verA  = A.get("version") or ""
-    verB  = B.get("version") or ""
+    return ORJSONResponse({"reply_markdown": md, "productA": A, "productB": B})
 
-    lines = [
-        f"**Sammenligning:** {nameA} (Rev. {verA}) vs {nameB} (Rev. {verB})",
-        "",
-        f"| Egenskap | {nameA} | {nameB} |",
-        "|---|---|---|",
-    ]
-    for p in A.get("typical_properties", []) or []:
-        key   = norm(p.get("property_name", ""))
-        q     = mapB.get(key)
-        valA  = p.get("value", "—")
-        valB  = q.get("value", "—") if q else "—"
-        methA = f" ({p.get('test_method')})" if p.get("test_method") else ""
-        methB = f" ({q.get('test_method')})" if q and q.get("test_method") else ""
-        lines.append(f"| {p.get('property_name','')} | {valA}{methA} | {valB}{methB} |")
-
-    lines.append("")
-    lines.append("**Godkjenninger / spesifikasjoner:**")
-    if A.get("approvals_and_specs"):
-        lines.append("- " + nameA + ": " + "; ".join(A["approvals_and_specs"]))
-    if B.get("approvals_and_specs"):
-        lines.append("- " + nameB + ": " + "; ".join(B["approvals_and_specs"]))
 
-    return JSONResponse({"reply_markdown": "\n".join(lines), "productA": A, "productB": B})
+# ------------------------- DRIVE DIAGNOSTICS -------------------------
+# Blocking Drive API calls and file writes run on _IO_POOL so the event loop stays free;
+# each worker thread keeps its own Drive service (see get_thread_drive_service).
+_IO_POOL = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="drive")
+# PDF text extraction is CPU-bound, so synced files are parsed in separate processes
+# Spawned, not forked: a fork taken while a request thread is inside PDFium would copy its held
+# lock (and PDFium's global state) into every worker, which then deadlocks on first parse.
+def _new_parse_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+
+_PARSE_POOL = _new_parse_pool()
+_PARSE_POOL_LOCK = threading.Lock()
+
+
+def _replace_parse_pool(broken: ProcessPoolExecutor) -> None:
+    """A dead worker poisons its pool for good; swap in a fresh one (once, however many callers saw it)."""
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is broken:
+            _PARSE_POOL = _new_parse_pool()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _drive_about() -> dict:
+    return get_thread_drive_service().about().get(fields="user,kind").execute()
+
+
+def _drive_list(folder_id: str) -> list:
+    return list_pdfs_in_folder(get_thread_drive_service(), folder_id)
 
 
-# ------------------------- DRIVE DIAGNOSTICS -------------------------
 @app.get("/drive/check")
-def drive_check():
+async def drive_check():
     try:
-        svc = get_drive_service()
-        about = svc.about().get(fields="user,kind").execute()
+        about = await asyncio.get_running_loop().run_in_executor(_IO_POOL, _drive_about)
         return {"ok": True, "user": about.get("user")}
     except Exception as e:
-        import traceback
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"ok": False, "error": str(e), "trace": traceback.format_exc()},
         )
@@ -233,7 +546,7 @@ def drive_check():
 
 @app.get("/drive/index")
 def drive_index():
-    idx = _load_index()
+    idx = _index_snapshot()
     return {
         "count": len(idx),
         "items": [{"name": k, "stored_as": v} for k, v in idx.items()]
@@ -241,24 +554,72 @@ def drive_index():
 
 
 @app.get("/drive/list")
-def drive_list(folder_id: Optional[str] = None):
+async def drive_list(folder_id: Optional[str] = None):
     fid = folder_id or os.getenv("DRIVE_FOLDER_ID")
     if not fid:
         raise HTTPException(400, "No folder id; set DRIVE_FOLDER_ID or pass ?folder_id=")
     try:
-        svc = get_drive_service()
-        files = list_pdfs_in_folder(svc, fid)
+        files = await asyncio.get_running_loop().run_in_executor(_IO_POOL, _drive_list, fid)
         return {"ok": True, "count": len(files), "sample": files[:5]}
     except Exception as e:
-        import traceback
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"ok": False, "error": str(e), "trace": traceback.format_exc()},
         )
         
 
+def _store_parsed(f: dict, local: Path, parsed: dict) -> dict:
+    """Write parsed JSON and index one synced PDF; returns its drive_cache.json entry."""
+    # Same file and _cache_key as _load_parsed, so later lookups skip the parse
+    parsed_path = _parsed_path(local)
+    st = local.stat()
+    _write_json_atomic(parsed_path, {**parsed, "_cache_key": [str(local), st.st_mtime_ns, st.st_size]})
+
+    # Primary key: product name from the sheet (fallback to filename stem)
+    name = (parsed.get("product_name_line") or local.stem).strip()
+    if name:
+        _save_index_entry(name, local)
+
+    # ALSO index by filename stem so exact stems work immediately
+    _save_index_entry(local.stem, local)
+
+    return {
+        "name": name,
+        "modifiedTime": f.get("modifiedTime"),
+        "md5Checksum": f.get("md5Checksum"),
+        "local_path": str(local),
+        "parsed_path": str(parsed_path),
+    }
+
+
+async def _sync_one(f: dict, sem: asyncio.Semaphore) -> dict:
+    """Download over the shared async client, parse on the process pool, then store."""
+    loop = asyncio.get_running_loop()
+    local = DATA_DIR / safe_name(f["name"])
+    async with sem:
+        token = await loop.run_in_executor(_IO_POOL, get_access_token)
+        await download_pdf_async(app.state.http, token, f["id"], local)
+    for attempt in range(2):
+        pool = _PARSE_POOL
+        try:
+            parsed = await loop.run_in_executor(pool, extract_pds, str(local))
+            break
+        except BrokenProcessPool:
+            # A worker died (OOM, native crash on a malformed PDF) and took every in-flight
+            # parse with it; retry once on a fresh pool, so only a file that kills it again fails
+            _replace_parse_pool(pool)
+            if attempt:
+                raise
+    return await loop.run_in_executor(_IO_POOL, _store_parsed, f, local, parsed)
+
+
+def _persist_sync_state(cache: dict) -> None:
+    _flush_index()
+    _write_json_atomic(DRIVE_CACHE_PATH, cache, STATE_JSON_OPTS)
+
+
 @app.post("/drive/sync")
-def drive_sync(
+async def drive_sync(
     request: Request,                 # <-- NOT Optional and no default
     folder_id: Optional[str] = None,
     limit: int = 10,
@@ -266,6 +627,7 @@ def drive_sync(
     """
     Download a batch of PDFs from Drive, parse once, write parsed JSON,
     and update the name->file index for name-based lookup.
+    Files whose md5Checksum (or modifiedTime) matches drive_cache.json are not downloaded again.
     """
     try:
         fid = folder_id or os.getenv("DRIVE_FOLDER_ID")
@@ -277,29 +639,45 @@ def drive_sync(
         if token and request.headers.get("X-Sync-Token") != token:
             raise HTTPException(403, "Forbidden")
 
-        svc = get_drive_service()
-        files = list_pdfs_in_folder(svc, fid)
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(_IO_POOL, _drive_list, fid)
         files = files[: max(1, int(limit))]
+        # Same-named files (or names safe_name collapses) share one local path; downloading them
+        # concurrently would interleave one .part file, so keep the last, as a serial overwrite did
+        files = list({safe_name(f["name"]): f for f in files}.values())
 
+        cache = _load_drive_cache()
         results = []
+        todo = []
         for f in files:
-            local = DATA_DIR / safe_name(f["name"])
-            download_pdf(svc, f["id"], local)
-
-            parsed = extract_pds(str(local))
-            (PARSED_DIR / (local.stem + ".json")).write_text(
-                json.dumps(parsed, ensure_ascii=False, indent=2), encoding="utf-8"
-            )
-
-            # Primary key: product name from the sheet (fallback to filename stem)
-            name = (parsed.get("product_name_line") or local.stem).strip()
-            if name:
+            entry = cache.get(f["id"])
+            if _is_unchanged(entry, f):
+                # Same content as last sync: skip download and parse
+                local = Path(entry["local_path"])
+                name = entry.get("name") or local.stem
                 _save_index_entry(name, local)
-
-            # ALSO index by filename stem so exact stems work immediately
-            _save_index_entry(local.stem, local)
-
-            results.append({"name": name, "stored_as": str(local)})
+                _save_index_entry(local.stem, local)
+                results.append({"name": name, "stored_as": str(local), "cached": True})
+            else:
+                todo.append(f)
+
+        sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        outcomes = await asyncio.gather(
+            *(_sync_one(f, sem) for f in todo),
+            return_exceptions=True,
+        )
+        errors = []
+        for f, outcome in zip(todo, outcomes):
+            if isinstance(outcome, BaseException):
+                errors.append(outcome)
+                continue
+            cache[f["id"]] = outcome
+            results.append({"name": outcome["name"], "stored_as": outcome["local_path"], "cached": False})
+
+        # One index/cache write per sync, keeping whatever was processed before a failure
+        await loop.run_in_executor(_IO_POOL, _persist_sync_state, cache)
+        if errors:
+            raise errors[0]
 
         return {
             "processed": len(results),
@@ -309,8 +687,7 @@ def drive_sync(
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"ok": False, "error": str(e), "trace": traceback.format_exc()},
         )
@@ -320,23 +697,9 @@ def drive_sync(
 @app.post("/summary/by-name")
 def summary_by_name(req: NameReq):
     pA = _resolve_by_name(req.product_a_name)
-    A = extract_pds(str(pA))
+    A = _extract(pA)
 
-    approvals = A.get("approvals_and_specs", []) or []
-    approvals_md = "- " + "; ".join(approvals) if approvals else "—"
-    props = A.get("typical_properties", []) or []
-    props_md = "\n".join(
-        f"- {p.get('property_name','')}: {p.get('value','')}"
-        + (f" ({p.get('test_method')})" if p.get('test_method') else "")
-        for p in props
-    )
-
-    md = (
-        f"**Product:** {A.get('product_name_line') or pA.name}\n\n"
-        f"**Revision:** {A.get('version') or '—'}\n\n"
-        f"**Approvals / Specifications:**\n{approvals_md}\n\n"
-        f"**Typical properties:**\n{props_md}"
-    )
+    md = _render_summary(A, pA.name)
     return {"reply_markdown": md, "productA": A}
 
 
@@ -348,38 +711,9 @@ def compare_by_name(req: NameReq):
     pA = _resolve_by_name(req.product_a_name)
     pB = _resolve_by_name(req.product_b_name)
 
-    A = extract_pds(str(pA))
-    B = extract_pds(str(pB))
-
-    import re as _re
-    norm = lambda s: _re.sub(r"\s+", " ", (s or "").strip()).lower()
-    mapB = {norm(p.get("property_name", "")): p for p in B.get("typical_properties", []) or []}
-
-    nameA = A.get("product_name_line") or pA.name
-    nameB = B.get("product_name_line") or pB.name
-    verA  = A.get("version") or ""
-    verB  = B.get("version") or ""
+    A = _extract(pA)
+    B = _extract(pB)
 
-    lines = [
-        f"**Sammenligning:** {nameA} (Rev. {verA}) vs {nameB} (Rev. {verB})",
-        "",
-        f"| Egenskap | {nameA} | {nameB} |",
-        "|---|---|---|",
-    ]
-    for p in A.get("typical_properties", []) or []:
-        key   = norm(p.get("property_name", ""))
-        q     = mapB.get(key)
-        valA  = p.get("value", "—")
-        valB  = q.get("value", "—") if q else "—"
-        methA = f" ({p.get('test_method')})" if p.get("test_method") else ""
-        methB = f" ({q.get('test_method')})" if q and q.get("test_method") else ""
-        lines.append(f"| {p.get('property_name','')} | {valA}{methA} | {valB}{methB} |")
-
-    lines.append("")
-    lines.append("**Godkjenninger / spesifikasjoner:**")
-    if A.get("approvals_and_specs"):
-        lines.append("- " + nameA + ": " + "; ".join(A["approvals_and_specs"]))
-    if B.get("approvals_and_specs"):
-        lines.append("- " + nameB + ": " + "; ".join(B["approvals_and_specs"]))
+    md = _render_comparison(A, B, pA.name, pB.name)
 
-    return {"reply_markdown": "\n".join(lines), "productA": A, "productB": B}
+    return {"reply_markdown": md, "productA": A, "productB": B}
@@ -1,27 +1,131 @@
 # pds_extractor.py
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+import pypdfium2 as pdfium
 from PyPDF2 import PdfReader
 
+# ---------- patterns (compiled once at import) ----------
+
+# Blank runs that need rewriting to one space; a lone space (most word gaps) is left alone
+_BLANKS_RE = re.compile(r"(?: [ \t]|\t)[ \t]*")
+_NL3_RE = re.compile(r"\n{3,}")
+_WS_RE = re.compile(r"\s+")
+# lone CR -> LF, plus various minus/degree/superscripts and units, in one pass
+_TEXT_TABLE = str.maketrans({"\r": "\n", "º": "°", "–": "-", "—": "-", "²": "2"})
+_ITEM_RE = re.compile(r"[^;\n•\-]+")
+
+_VERSION_PATS = (
+    re.compile(r"(?:Revision|Rev\.?|Version)\s*[: ]\s*([A-Za-z0-9./ -]{2,})", re.I),
+    re.compile(r"\b(\d{3}/\d+[A-Za-z]?)\b"),
+    re.compile(r"\b(\d{2,4}/\d{1,2}[A-Za-z]?)\b"),
+)
+
+_APPROVAL_ANCHORS = (
+    re.compile(r"Approvals?\s*&?\s*/?\s*Specifications?", re.I),
+    re.compile(r"Specifications?", re.I),
+    re.compile(r"Performance(?: levels?)?", re.I),
+    re.compile(r"Meets (?:or exceeds )?the requirements of", re.I),
+    re.compile(r"\b(API|ACEA|ILSAC|JASO|VW|MB|BMW|FORD|GM|DEXOS)\b", re.I),
+)
+_APPROVAL_STOPS = (
+    re.compile(r"Typical (?:properties|characteristics|values|data)", re.I),
+    re.compile(r"Typical", re.I),
+    re.compile(r"Health|Safety|Handling", re.I),
+    re.compile(r"Storage", re.I),
+    re.compile(r"\n[A-Z ]{4,}\n"),  # next all-caps header
+)
+# Lines that look like approvals/specs (contain known tokens)
+_KEEP_TOKENS_RE = re.compile(
+    r"\b(API|ACEA|ILSAC|JASO|VW|MB|BMW|FORD|GM|DEXOS|PSA|FIAT|RENAULT|VOLVO|MAN|CUMMINS|ALLISON)\b", re.I
+)
+
+_TYPICAL_ANCHORS = (
+    re.compile(r"Typical (?:properties|characteristics|values|data)", re.I),
+)
+_TYPICAL_STOPS = (
+    re.compile(r"Approvals?|Specifications?|Performance", re.I),
+    re.compile(r"Health|Safety|Handling|Storage", re.I),
+    re.compile(r"\n[A-Z ]{4,}\n"),
+)
+# Regex that captures: name ... : value (ASTM D-xxx)
+# Backtracking guards (lines come from user uploads):
+#  - the value must reach a digit within its first two chars (".865" keeps its leading point),
+#    so a separator inside a run of leader dots ("Appearance ........ Clear") fails at once
+#    instead of trying every split of the run;
+#  - number and unit tail are atomic, (?=(?P<x>...))(?P=x) (possessive needs 3.11), so they
+#    cannot trade '.' between them; giving chars back could never turn a failure into a match;
+#  - no two adjacent quantifiers share whitespace (name/value keep spaces, which _norm strips).
+_ROW_RE = re.compile(
+    r"^(?P<name>[A-Za-z].*?)[:.]\s*"                                        # property name
+    r"(?P<value>(?:[<>]\s*)?(?=(?P<num>[.,]?\d[\d.,]*))(?P=num)"                  # value ...
+    r"(?=(?P<unit>[A-Za-zµ%°/.\-\s]*))(?P=unit))"                            # ... w/ units
+    r"(?:\(\s*(?P<method>ASTM[^)]*)\))?$"                                   # optional (ASTM ...)
+)
+# If no row parses, a looser grab for a few well-known keys
+_LOOSE_PATS = (
+    ("Viscosity", re.compile(r"(Viscosity[^:\n]+)[:\.]\s*([^\n]+)")),
+    ("Viscosity Index", re.compile(r"(Viscosity Index)[:\.]\s*([^\n]+)")),
+    ("Pour Point", re.compile(r"(Pour Point)[^:\n]*[:\.]\s*([^\n]+)")),
+    ("Flash Point", re.compile(r"(Flash Point)[^:\n]*[:\.]\s*([^\n]+)")),
+    ("Specific Gravity", re.compile(r"(Specific Gravity[^:\n]*)[:\.]\s*([^\n]+)")),
+    ("TBN", re.compile(r"(TBN[^:\n]*)[:\.]\s*([^\n]+)")),
+)
+
+# PDFium is not thread-safe, even across separate documents; the API parses on a threadpool
+_PDFIUM_LOCK = threading.Lock()
+
 # ---------- helpers ----------
 
-def _read_text(pdf_path: str) -> str:
-    reader = PdfReader(pdf_path)
-    texts = []
-    for page in reader.pages:
+def _pages_pdfium(pdf_path: str) -> Tuple[List[str], str]:
+    """Page texts and metadata title via PDFium's native text extractor (one caller at a time)."""
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
         try:
-            texts.append(page.extract_text() or "")
-        except Exception:
-            texts.append("")
+            texts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_bounded())
+                textpage.close()
+                page.close()
+            title = (pdf.get_metadata_dict().get("Title") or "").strip()
+        finally:
+            pdf.close()
+    return texts, title
+
+def _safe_extract(page) -> str:
+    """Text of one PyPDF2 page; a page that fails to decode contributes nothing."""
+    with suppress(Exception):
+        return page.extract_text() or ""
+    return ""
+
+def _pages_pypdf2(pdf_path: str) -> Tuple[List[str], str]:
+    """Pure-Python fallback for files PDFium refuses to open."""
+    reader = PdfReader(pdf_path)
+    texts = list(map(_safe_extract, reader.pages))
+    try:
+        meta = reader.metadata or {}
+        title = (meta.get("/Title") or meta.get("Title") or "").strip()
+    except Exception:
+        title = ""
+    return texts, title
+
+def _read_text(pdf_path: str) -> Tuple[str, str]:
+    """Normalized page text plus the metadata title (read once, for the product-name fallback)."""
+    try:
+        texts, title = _pages_pdfium(pdf_path)
+    except Exception:
+        texts, title = _pages_pypdf2(pdf_path)
     # Normalize whitespace & some symbols so regex is simpler
     raw = "\n".join(texts)
-    raw = raw.replace("\r", "\n")
-    raw = re.sub(r"[ \t]+", " ", raw)
-    raw = re.sub(r"\n{3,}", "\n\n", raw)
-    # unify various minus/degree/superscripts and units
-    raw = raw.replace("º", "°").replace("–", "-").replace("—", "-").replace("²", "2")
-    return raw
+    # PDFium ends lines with CRLF; fold it before lone CRs so it doesn't become a blank line
+    raw = raw.replace("\r\n", "\n").translate(_TEXT_TABLE)
+    raw = _BLANKS_RE.sub(" ", raw)
+    raw = _NL3_RE.sub("\n\n", raw)
+    return raw, title
 
 def _first(lines: List[str], pattern: re.Pattern, default: Optional[str] = None) -> Optional[str]:
     for ln in lines:
@@ -32,10 +136,10 @@ def _first(lines: List[str], pattern: re.Pattern, default: Optional[str] = None)
 
 def _norm(s: str) -> str:
     s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
-def _section_after(text: str, anchors: List[re.Pattern], stop_markers: List[re.Pattern], max_chars: int = 1500) -> Optional[str]:
+def _section_after(text: str, anchors: Sequence[re.Pattern], stop_markers: Sequence[re.Pattern], max_chars: int = 1500) -> Optional[str]:
     """
     Find a section that starts at the first anchor match and ends at the first stop marker or after max_chars.
     """
@@ -49,28 +153,23 @@ def _section_after(text: str, anchors: List[re.Pattern], stop_markers: List[re.P
         return None
 
     end = len(text)
-    snippet = text[start:start + max_chars]
-    # stop at next header-like marker or named section
+    # stop at next header-like marker or named section (searched in place, no snippet copy;
+    # none of the stop markers look behind start, so bounds behave like a slice)
     for pat in stop_markers:
-        m2 = pat.search(snippet)
+        m2 = pat.search(text, start, start + max_chars)
         if m2:
-            end = start + m2.start()
+            end = m2.start()
             break
     return text[start:end]
 
 def _split_items(blob: str) -> List[str]:
     # split by newlines, bullets, semicolons, commas – keep compact items
-    parts = re.split(r"[;\n•\-]\s*", blob)
-    items = []
-    for p in parts:
-        p = _norm(p)
-        if p:
-            items.append(p)
-    return items
+    # (runs between separators; _norm strips the whitespace a split used to swallow)
+    return [item for part in _ITEM_RE.findall(blob) if (item := _norm(part))]
 
 # ---------- extractors ----------
 
-def _extract_product_name(text: str, pdf_path: str) -> Optional[str]:
+def _extract_product_name(text: str, pdf_path: str, title: str = "") -> Optional[str]:
     """
     Try multiple strategies:
       1) Look for a line starting with 'Valvoline' within the first ~1000 chars.
@@ -78,22 +177,18 @@ def _extract_product_name(text: str, pdf_path: str) -> Optional[str]:
       3) Fallback: filename stem.
     """
     head = text[:2000]
-    # Lines that look like a product heading
-    for ln in head.splitlines():
-        s = ln.strip()
-        if not s:
-            continue
-        if s.lower().startswith("valvoline"):
-            # trim trailing codes if the next line is 'Typical properties' etc.
-            return _norm(s)
+    # Lines that look like a product heading; one C-level scan rules out sheets that never
+    # mention the brand (no line can start with it then) before walking the lines
+    if "valvoline" in head.lower():
+        for ln in head.splitlines():
+            s = ln.strip()
+            if not s:
+                continue
+            if s.lower().startswith("valvoline"):
+                # trim trailing codes if the next line is 'Typical properties' etc.
+                return _norm(s)
 
-    # PDF metadata title
-    try:
-        reader = PdfReader(pdf_path)
-        meta = reader.metadata or {}
-        title = (meta.get("/Title") or meta.get("Title") or "").strip()
-    except Exception:
-        title = ""
+    # PDF metadata title (read alongside the text in _read_text)
     if title:
         return _norm(title)
 
@@ -103,12 +198,7 @@ def _extract_product_name(text: str, pdf_path: str) -> Optional[str]:
 
 def _extract_version(text: str) -> Optional[str]:
     # Common patterns: Revision, Rev., Version, issue codes like 306/06b etc.
-    pats = [
-        re.compile(r"(?:Revision|Rev\.?|Version)\s*[: ]\s*([A-Za-z0-9./ -]{2,})", re.I),
-        re.compile(r"\b(\d{3}/\d+[A-Za-z]?)\b"),
-        re.compile(r"\b(\d{2,4}/\d{1,2}[A-Za-z]?)\b"),
-    ]
-    for p in pats:
+    for p in _VERSION_PATS:
         m = p.search(text)
         if m:
             return _norm(m.group(1).replace(" / ", "/").replace("  ", " "))
@@ -119,41 +209,19 @@ def _extract_approvals(text: str) -> List[str]:
     Motorcycle PDS often uses headings like 'Specifications', 'Performance', 'Meets requirements',
     or lists API/JASO directly. We gather from a section starting at any of these anchors.
     """
-    anchors = [
-        re.compile(r"Approvals?\s*&?\s*/?\s*Specifications?", re.I),
-        re.compile(r"Specifications?", re.I),
-        re.compile(r"Performance(?: levels?)?", re.I),
-        re.compile(r"Meets (?:or exceeds )?the requirements of", re.I),
-        re.compile(r"\b(API|ACEA|ILSAC|JASO|VW|MB|BMW|FORD|GM|DEXOS)\b", re.I),
-    ]
-    stops = [
-        re.compile(r"Typical (?:properties|characteristics|values|data)", re.I),
-        re.compile(r"Typical", re.I),
-        re.compile(r"Health|Safety|Handling", re.I),
-        re.compile(r"Storage", re.I),
-        re.compile(r"\n[A-Z ]{4,}\n"),  # next all-caps header
-    ]
-    blob = _section_after(text, anchors, stops, max_chars=1500)
+    blob = _section_after(text, _APPROVAL_ANCHORS, _APPROVAL_STOPS, max_chars=1500)
     if not blob:
         # fallback: scan entire text for obvious approvals tokens
         blob = text[:3000]
 
-    # Keep only lines that look like approvals/specs (contain known tokens)
-    keep_tokens = re.compile(r"\b(API|ACEA|ILSAC|JASO|VW|MB|BMW|FORD|GM|DEXOS|PSA|FIAT|RENAULT|VOLVO|MAN|CUMMINS|ALLISON)\b", re.I)
-    items = []
-    for line in _split_items(blob):
-        if keep_tokens.search(line):
-            items.append(line)
-
-    # unique while preserving order
+    # Keep only lines that look like approvals/specs (contain known tokens; re.I folds case in C),
+    # unique (case-insensitively) while preserving order; only kept lines are lowered, once,
+    # and set.add returns None, so it only records
     seen = set()
-    out = []
-    for it in items:
-        key = it.lower()
-        if key not in seen:
-            seen.add(key)
-            out.append(it)
-    return out
+    return [
+        it for it in _split_items(blob)
+        if _KEEP_TOKENS_RE.search(it) and (key := it.lower()) not in seen and not seen.add(key)
+    ]
 
 def _extract_typical_properties(text: str) -> List[Dict[str, Any]]:
     """
@@ -161,33 +229,14 @@ def _extract_typical_properties(text: str) -> List[Dict[str, Any]]:
     Keep the original value string (commas or dots).
     """
     # Narrow to typical properties section if we can find it
-    anchors = [
-        re.compile(r"Typical (?:properties|characteristics|values|data)", re.I),
-    ]
-    stops = [
-        re.compile(r"Approvals?|Specifications?|Performance", re.I),
-        re.compile(r"Health|Safety|Handling|Storage", re.I),
-        re.compile(r"\n[A-Z ]{4,}\n"),
-    ]
-    section = _section_after(text, anchors, stops, max_chars=3000) or text
+    section = _section_after(text, _TYPICAL_ANCHORS, _TYPICAL_STOPS, max_chars=3000) or text
 
-    lines = [ln.strip() for ln in section.splitlines() if ln.strip()]
+    lines = [s for ln in section.splitlines() if (s := ln.strip())]
     props: List[Dict[str, Any]] = []
     ordinal = 1
 
-    # Regex that captures: name ... : value (ASTM D-xxx)
-    row_re = re.compile(
-        r"""^
-            (?P<name>[A-Za-z].*?)            # property name
-            \s*[:\.]\s*
-            (?P<value>[<>]?\s*[\d\.,]+(?:\s*[A-Za-zµ%°/.\-\s]+)?) # value w/ units
-            (?:\s*\(\s*(?P<method>ASTM[^)]*)\))? # optional (ASTM ...)
-        $""",
-        re.X
-    )
-
     for ln in lines:
-        m = row_re.match(ln)
+        m = _ROW_RE.match(ln)
         if not m:
             continue
         name = _norm(m.group("name"))
@@ -207,15 +256,7 @@ def _extract_typical_properties(text: str) -> List[Dict[str, Any]]:
 
     # If nothing parsed, try a looser grab for a few well-known keys
     if not props:
-        loose = [
-            ("Viscosity", re.compile(r"(Viscosity[^:\n]+)[:\.]\s*([^\n]+)")),
-            ("Viscosity Index", re.compile(r"(Viscosity Index)[:\.]\s*([^\n]+)")),
-            ("Pour Point", re.compile(r"(Pour Point)[^:\n]*[:\.]\s*([^\n]+)")),
-            ("Flash Point", re.compile(r"(Flash Point)[^:\n]*[:\.]\s*([^\n]+)")),
-            ("Specific Gravity", re.compile(r"(Specific Gravity[^:\n]*)[:\.]\s*([^\n]+)")),
-            ("TBN", re.compile(r"(TBN[^:\n]*)[:\.]\s*([^\n]+)")),
-        ]
-        for label, rx in loose:
+        for label, rx in _LOOSE_PATS:
             m = rx.search(section)
             if m:
                 props.append({
@@ -231,10 +272,9 @@ def _extract_typical_properties(text: str) -> List[Dict[str, Any]]:
 # ---------- public API ----------
 
 def extract_pds(pdf_path: str) -> Dict[str, Any]:
-    text = _read_text(pdf_path)
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    text, title = _read_text(pdf_path)
 
-    product = _extract_product_name(text, pdf_path)
+    product = _extract_product_name(text, pdf_path, title)
     version = _extract_version(text)
     approvals = _extract_approvals(text)
     props = _extract_typical_properties(text)
@@ -250,3 +290,11 @@ def extract_pds(pdf_path: str) -> Dict[str, Any]:
         "approvals_and_specs": approvals,
         "typical_properties": props,
     }
+
+def extract_pds_batch(pdf_paths: List[str], workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Parse many PDFs across worker processes (parsing is CPU-bound), results in input order.
+    Each call opens and closes its own document, so nothing unpicklable crosses the pool.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(extract_pds, pdf_paths, chunksize=4))
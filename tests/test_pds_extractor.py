@@ -0,0 +1,33 @@
+import time
+
+from pds_extractor import _ROW_RE, _extract_typical_properties
+
+
+def test_row_regex_parses_a_typical_row():
+    m = _ROW_RE.match("Viscosity , mm2/s @ 100 °C.: 17,5 (ASTM D-445)")
+    assert m and m.group("value").strip() == "17,5" and m.group("method") == "ASTM D-445"
+
+
+def test_row_regex_leader_dots_fail_fast():
+    # A non-matching leader-dot line used to backtrack cubically (16 s at 1000 dots)
+    line = "Appearance " + "." * 5000 + " Clear & bright"
+    start = time.perf_counter()
+    assert _ROW_RE.match(line) is None
+    assert time.perf_counter() - start < 0.5
+
+
+def test_leader_dot_line_is_not_a_row():
+    text = "Typical properties\nFlash Point, °C: 230 (ASTM D-92)\nAppearance ........ Clear\n"
+    props = _extract_typical_properties(text)
+    assert [(p["property_name"], p["value"], p["test_method"]) for p in props] == [
+        ("Flash Point, °C", "230", "ASTM D-92")
+    ]
+
+
+def test_leading_decimal_point_value_is_kept():
+    text = "Typical properties\nDensity @ 15°C, kg/l: .865\nSpecific Gravity: .875 (ASTM D-1298)\n"
+    props = _extract_typical_properties(text)
+    assert [(p["property_name"], p["value"], p["test_method"]) for p in props] == [
+        ("Density @ 15°C, kg/l", ".865", None),
+        ("Specific Gravity", ".875", "ASTM D-1298"),
+    ]